@@ -59,12 +59,17 @@ also contribute to the mapped blocks and are also copied.
 import os
 import stat
 import sys
+import mmap
+import fcntl
+import errno
+import ctypes
+import collections
 import hashlib
 import logging
 import datetime
-from six import reraise
-from six.moves import queue as Queue
-from six.moves import _thread as thread
+import traceback
+import threading
+from six import reraise, PY2
 from xml.etree import ElementTree
 from bmaptools.BmapHelpers import human_size
 
@@ -73,6 +78,53 @@ _log = logging.getLogger(__name__)  # pylint: disable=C0103
 # The highest supported bmap format version
 SUPPORTED_BMAP_VERSION = "2.0"
 
+# Flags of the 'sync_file_range()' system call
+_SYNC_FILE_RANGE_WAIT_BEFORE = 1
+_SYNC_FILE_RANGE_WRITE = 2
+_SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# How many requests can be queued to 'io_uring' at a time
+_URING_DEPTH = 32
+
+# The maximum count of the hashing threads
+_MAX_HASH_LANES = 4
+
+# The block device queue attributes changed by 'BmapBdevCopy'
+_TUNED_QUEUE_ATTRS = ("nr_requests", "read_ahead_kb", "add_random")
+
+
+def _get_sync_file_range():
+    """
+    Return the 'sync_file_range()' function of the C library, or 'None' if
+    it is not available. Python does not provide this system call in the 'os'
+    module, so we use 'ctypes'.
+    """
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = libc.sync_file_range
+    except (OSError, AttributeError):
+        return None
+
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                     ctypes.c_uint]
+    func.restype = ctypes.c_int
+    return func
+
+_sync_file_range = _get_sync_file_range()  # pylint: disable=C0103
+
+
+def _alloc_buf(size):
+    """
+    Allocate a 'size' bytes long batch buffer. Anonymous mappings are
+    page-aligned, which is required for direct I/O. But Python 2 cannot create
+    memoryviews of mappings, so 'bytearray' objects are used there.
+    """
+
+    if PY2:
+        return bytearray(size)
+    return mmap.mmap(-1, size)
+
 
 class Error(Exception):
     """
@@ -96,7 +148,10 @@ class BmapCopy(object):
 
     Although the main purpose of this class is to use bmap, the bmap is not
     required, and if it was not provided then the entire image will be copied
-    to the destination file.
+    to the destination file. The only exception are the holes of local image
+    files, which are not copied to regular destination files. The old contents
+    of the destination file are discarded instead, so the holes read as zeroes
+    there.
 
     When the bmap is provided, it is not necessary to specify image size,
     because the size is contained in the bmap. Otherwise, it is benefitial to
@@ -143,18 +198,35 @@ class BmapCopy(object):
             image_size - size of the image in bytes.
         """
 
-        self._xml = None
-
         self._dest_fsync_watermark = None
+        self._fsync_last = 0
+        self._prev_batch_range = None
+        self._range_sync_supported = _sync_file_range is not None
         self._batch_blocks = None
-        self._batch_queue = None
         self._batch_bytes = 1024 * 1024
         self._batch_queue_len = 6
 
+        # The batch buffers and the events used for passing them between the
+        # reader thread, the hashing threads and the main thread
+        self._bufs = None
+        self._buf_info = None
+        self._buf_free = None
+        self._buf_ready = None
+        self._buf_hash_ready = None
+        self._buf_hashed = None
+        self._hashing = False
+        self._hash_lanes = 0
+        self._hash_error = None
+        self._copy_aborted = False
+
         self.bmap_version = None
         self.bmap_version_major = None
         self.bmap_version_minor = None
         self.block_size = None
+        # 'block_size' is a power of 2, so block numbers are calculated with
+        # shifts
+        self._bs_shift = None
+        self._bs_mask = None
         self.blocks_cnt = None
         self.mapped_cnt = None
         self.image_size = None
@@ -168,6 +240,7 @@ class BmapCopy(object):
 
         self._progress_started = None
         self._progress_index = None
+        self._progress_percent = None
         self._progress_time = None
         self._progress_file = None
         self._progress_format = None
@@ -176,11 +249,25 @@ class BmapCopy(object):
 
         self._f_image = image
         self._image_path = image.name
+        self._image_fd = self._get_image_fd()
+        # Python versions older than 3.7 do not have 'os.preadv()'
+        self._image_preadv = self._image_fd is not None and \
+                             hasattr(os, "preadv")
+        if self._image_fd is not None and hasattr(os, "posix_fadvise"):
+            # Ask the kernel for more aggressive read-ahead
+            try:
+                os.posix_fadvise(self._image_fd, 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+            except OSError as err:
+                _log.debug("cannot advise sequential access to '%s': %s"
+                           % (self._image_path, err))
 
         self._f_dest = dest
         self._dest_path = dest.name
         st_data = os.fstat(self._f_dest.fileno())
         self._dest_is_regfile = stat.S_ISREG(st_data.st_mode)
+        # Python 2 does not have 'os.posix_fadvise()'
+        self._dest_drop_cache = hasattr(os, "posix_fadvise")
 
         # The bmap file checksum type and length
         self._cs_type = None
@@ -204,14 +291,44 @@ class BmapCopy(object):
             # There is no bmap. Initialize user-visible attributes to something
             # sensible with an assumption that we just have all blocks mapped.
             self.bmap_version = 0
-            self.block_size = 4096
+            self._set_block_size(4096)
             self.mapped_percent = 100
 
         if image_size:
             self._set_image_size(image_size)
 
+        # When there is no bmap but the image is a local file, we can still
+        # skip the holes in the image, because they read as zeroes in the
+        # destination file anyway.
+        self._image_data_ranges = None
+        if not bmap and self.image_size and self._dest_is_regfile and \
+           self._image_fd is not None:
+            self._image_data_ranges = self._find_image_data()
+            if self._image_data_ranges is not None:
+                self._set_mapped_cnt(sum(last - first + 1 for (first, last)
+                                         in self._image_data_ranges))
+
         self._batch_blocks = self._batch_bytes // self.block_size
 
+    def _get_image_fd(self):
+        """
+        Return the file descriptor of the image file if the image is a local
+        uncompressed regular file, which means that the kernel can read it
+        directly. Otherwise return 'None'.
+        """
+
+        try:
+            image_fd = self._f_image.fileno()
+            st_data = os.fstat(image_fd)
+        except (AttributeError, ValueError, IOError, OSError):
+            # E.g., 'TransRead' objects of compressed files or URLs do not have
+            # file descriptors
+            return None
+
+        if stat.S_ISREG(st_data.st_mode):
+            return image_fd
+        return None
+
     def set_psplash_pipe(self, path):
         """
         Set the psplash named pipe file path to be used when updating the
@@ -265,21 +382,99 @@ class BmapCopy(object):
 
         self.image_size = image_size
         self.image_size_human = human_size(image_size)
-        self.blocks_cnt = (self.image_size + self.block_size - 1) // self.block_size
+        self.blocks_cnt = (self.image_size + self._bs_mask) >> self._bs_shift
 
         if self.mapped_cnt is None:
             self.mapped_cnt = self.blocks_cnt
             self.mapped_size = self.image_size
             self.mapped_size_human = self.image_size_human
 
-    def _verify_bmap_checksum(self):
+    def _set_block_size(self, block_size):
         """
-        This is a helper function which verifies the bmap file checksum.
+        Set the block size and the shift and the mask used for converting
+        byte offsets to block numbers.
+        """
+
+        if block_size <= 0 or block_size & (block_size - 1):
+            raise Error("bad block size %d: has to be a power of 2"
+                        % block_size)
+
+        self.block_size = block_size
+        self._bs_shift = block_size.bit_length() - 1
+        self._bs_mask = block_size - 1
+
+    def _set_mapped_cnt(self, mapped_cnt):
+        """
+        Set the mapped blocks count and the other attributes derived from it.
+        """
+
+        self.mapped_cnt = mapped_cnt
+        self.mapped_size = self.mapped_cnt * self.block_size
+        self.mapped_size_human = human_size(self.mapped_size)
+        self.mapped_percent = (self.mapped_cnt * 100.0) / self.blocks_cnt
+
+    def _find_image_data(self):
+        """
+        Find the mapped areas of the image file using the 'SEEK_DATA' and
+        'SEEK_HOLE' features of the 'lseek()' system call. Returns a list of
+        ('first', 'last') block ranges, or 'None' if the kernel or the
+        file-system do not support these features.
+        """
+
+        if not hasattr(os, "SEEK_DATA") or \
+           os.fstat(self._image_fd).st_size != self.image_size:
+            return None
+
+        ranges = []
+        offset = 0
+        saved_pos = os.lseek(self._image_fd, 0, os.SEEK_CUR)
+
+        try:
+            while offset < self.image_size:
+                try:
+                    start = os.lseek(self._image_fd, offset, os.SEEK_DATA)
+                except OSError as err:
+                    # ENXIO means that there is no more data after 'offset'
+                    if err.errno == errno.ENXIO:
+                        break
+                    _log.debug("cannot find data in image file '%s': %s"
+                               % (self._image_path, err))
+                    return None
+
+                offset = os.lseek(self._image_fd, start, os.SEEK_HOLE)
+
+                first = start >> self._bs_shift
+                last = ((min(offset, self.image_size) + self._bs_mask)
+                        >> self._bs_shift) - 1
+                if ranges and ranges[-1][1] >= first - 1:
+                    ranges[-1] = (ranges[-1][0], last)
+                else:
+                    ranges.append((first, last))
+        finally:
+            os.lseek(self._image_fd, saved_pos, os.SEEK_SET)
+
+        return ranges
+
+    def _new_hash_obj(self):
+        """
+        Create and return a new hash object for the bmap checksum type. The
+        checksums are only used for verifying data integrity, so tell the hash
+        library that it is not used for security purposes - this allows
+        OpenSSL to pick its fastest implementation (e.g., the one using the SHA
+        CPU instructions).
         """
 
-        import mmap
+        try:
+            return hashlib.new(self._cs_type, usedforsecurity=False)
+        except TypeError:
+            # Python versions older than 3.9 do not support 'usedforsecurity'
+            return hashlib.new(self._cs_type)
 
-        correct_chksum = self._xml.find(self._bmap_cs_attrib_name).text.strip()
+    def _verify_bmap_checksum(self, correct_chksum):
+        """
+        This is a helper function which verifies the bmap file checksum.
+        The 'correct_chksum' argument is the checksum stored in the bmap file.
+        """
 
         # Before verifying the shecksum, we have to substitute the checksum
         # value stored in the file with all zeroes. For these purposes we
@@ -292,7 +487,7 @@ class BmapCopy(object):
 
         mapped_bmap[chksum_pos:chksum_pos + self._cs_len] = b'0' * self._cs_len
 
-        hash_obj = hashlib.new(self._cs_type)
+        hash_obj = self._new_hash_obj()
         hash_obj.update(mapped_bmap)
         calculated_chksum = hash_obj.hexdigest()
 
@@ -303,13 +498,36 @@ class BmapCopy(object):
                         "'%s', should be '%s'"
                         % (self._bmap_path, calculated_chksum, correct_chksum))
 
-    def _parse_bmap(self):
+    def _iterparse_bmap(self):
         """
-        Parse the bmap file and initialize corresponding class instance attributs.
+        This is a helper generator which parses the bmap file from the very
+        beginning and yields ('element', 'parent_tag') tuples for all the
+        elements of the bmap XML file, where 'parent_tag' is the tag of the
+        parent element. The root element is yielded first, as soon as its start
+        tag is parsed, and its 'parent_tag' is 'None'. The other elements are
+        yielded once they are fully parsed.
+
+        The elements are removed from the XML tree right after they are
+        yielded, so the tree of a bmap file with many block ranges is never
+        kept in memory.
         """
 
+        self._f_bmap.seek(0)
+        parents = []
+
         try:
-            self._xml = ElementTree.parse(self._f_bmap)
+            for (event, elem) in ElementTree.iterparse(self._f_bmap,
+                                                       ("start", "end")):
+                if event == "start":
+                    if not parents:
+                        yield (elem, None)
+                    parents.append(elem)
+                    continue
+
+                parents.pop()
+                if parents:
+                    yield (elem, parents[-1].tag)
+                    parents[-1].remove(elem)
         except ElementTree.ParseError as err:
             # Extrace the erroneous line with some context
             self._f_bmap.seek(0)
@@ -322,8 +540,29 @@ class BmapCopy(object):
                         "proper XML file: %s, the XML extract:\n%s" %
                         (self._bmap_path, err, xml_extract))
 
-        xml = self._xml
-        self.bmap_version = str(xml.getroot().attrib.get('version'))
+    def _parse_bmap(self):
+        """
+        Parse the bmap file and initialize corresponding class instance attributs.
+        """
+
+        # Collect the text of the elements which describe the image, skipping
+        # the (potentially very many) block ranges, which are parsed later
+        # while copying.
+        header = {}
+        root_tag = None
+        for (elem, parent_tag) in self._iterparse_bmap():
+            if parent_tag is None:
+                root_tag = elem.tag
+                self.bmap_version = str(elem.attrib.get('version'))
+            elif parent_tag == root_tag:
+                header[elem.tag] = (elem.text or "").strip()
+
+        def get_header(tag):
+            """Return the text of the 'tag' element of the bmap file."""
+            if tag not in header:
+                raise Error("the bmap file '%s' does not contain the '%s' "
+                            "element" % (self._bmap_path, tag))
+            return header[tag]
 
         # Make sure we support this version
         self.bmap_version_major = int(self.bmap_version.split('.', 1)[0])
@@ -334,16 +573,13 @@ class BmapCopy(object):
                         % (SUPPORTED_BMAP_VERSION, self.bmap_version_major))
 
         # Fetch interesting data from the bmap XML file
-        self.block_size = int(xml.find("BlockSize").text.strip())
-        self.blocks_cnt = int(xml.find("BlocksCount").text.strip())
-        self.mapped_cnt = int(xml.find("MappedBlocksCount").text.strip())
-        self.image_size = int(xml.find("ImageSize").text.strip())
+        self._set_block_size(int(get_header("BlockSize")))
+        self.blocks_cnt = int(get_header("BlocksCount"))
+        self.image_size = int(get_header("ImageSize"))
         self.image_size_human = human_size(self.image_size)
-        self.mapped_size = self.mapped_cnt * self.block_size
-        self.mapped_size_human = human_size(self.mapped_size)
-        self.mapped_percent = (self.mapped_cnt * 100.0) / self.blocks_cnt
+        self._set_mapped_cnt(int(get_header("MappedBlocksCount")))
 
-        blocks_cnt = (self.image_size + self.block_size - 1) // self.block_size
+        blocks_cnt = (self.image_size + self._bs_mask) >> self._bs_shift
         if self.blocks_cnt != blocks_cnt:
             raise Error("Inconsistent bmap - image size does not match "
                         "blocks count (%d bytes != %d blocks * %d bytes)"
@@ -365,7 +601,7 @@ class BmapCopy(object):
             # 1.4 became version 2.0. So 1.4 and 2.0 formats are identical.
             #
             # Note, bmap files did not contain checksums prior to version 1.3.
-            self._cs_type = xml.find("ChecksumType").text.strip()
+            self._cs_type = get_header("ChecksumType")
             self._cs_attrib_name = "chksum"
             self._bmap_cs_attrib_name = "BmapFileChecksum"
         elif self.bmap_version_minor == 3:
@@ -375,11 +611,11 @@ class BmapCopy(object):
 
         if self._cs_type:
             try:
-                self._cs_len = len(hashlib.new(self._cs_type).hexdigest())
+                self._cs_len = len(self._new_hash_obj().hexdigest())
             except ValueError as err:
                 raise Error("cannot initialize hash function \"%s\": %s" %
                             (self._cs_type, err))
-            self._verify_bmap_checksum()
+            self._verify_bmap_checksum(get_header(self._bmap_cs_attrib_name))
 
     def _update_progress(self, blocks_written):
         """
@@ -391,15 +627,21 @@ class BmapCopy(object):
         if self.mapped_cnt:
             assert blocks_written <= self.mapped_cnt
             percent = int((float(blocks_written) / self.mapped_cnt) * 100)
-            _log.debug("wrote %d blocks out of %d (%d%%)" %
-                       (blocks_written, self.mapped_cnt, percent))
+            # This is called for every batch, so do not format the message
+            # unless it is actually printed
+            _log.debug("wrote %d blocks out of %d (%d%%)",
+                       blocks_written, self.mapped_cnt, percent)
         else:
-            _log.debug("wrote %d blocks" % blocks_written)
+            _log.debug("wrote %d blocks", blocks_written)
 
         if not self._progress_file:
             return
 
         if self.mapped_cnt:
+            # Do not re-print the same percentage
+            if percent == self._progress_percent:
+                return
+            self._progress_percent = percent
             progress = '\r' + self._progress_format % percent + '\n'
         else:
             # Do not rotate the wheel too fast
@@ -449,10 +691,16 @@ class BmapCopy(object):
             missing).
 
         If there is no bmap file, the generator just yields a single range
-        for entire image file. If the image size is unknown, the generator
-        infinitely yields continuous ranges of size '_batch_blocks'.
+        for entire image file, or the ranges of its mapped areas if they are
+        known. If the image size is unknown, the generator infinitely yields
+        continuous ranges of size '_batch_blocks'.
         """
 
+        if self._image_data_ranges is not None:
+            for (first, last) in self._image_data_ranges:
+                yield (first, last, None)
+            return
+
         if not self._f_bmap:
             # We do not have the bmap, yield a tuple with all blocks
             if self.blocks_cnt:
@@ -467,10 +715,10 @@ class BmapCopy(object):
             return
 
         # We have the bmap, just read it and yield block ranges
-        xml = self._xml
-        xml_bmap = xml.find("BlockMap")
+        for (xml_element, parent_tag) in self._iterparse_bmap():
+            if parent_tag != "BlockMap" or xml_element.tag != "Range":
+                continue
 
-        for xml_element in xml_bmap.findall("Range"):
             blocks_range = xml_element.text.strip()
             # The range of blocks has the "X - Y" format, or it can be just "X"
             # in old bmap format versions. First, split the blocks range string
@@ -492,6 +740,37 @@ class BmapCopy(object):
 
             yield (first, last, chksum)
 
+    def _get_coalesced_ranges(self, keep_chksums):
+        """
+        This is a wrapper over the '_get_block_ranges()' generator which merges
+        adjacent block ranges, so that the I/O is done in larger batches. The
+        'keep_chksums' argument defines whether the checksums are needed. If
+        they are, ranges which have checksums are never merged, because the
+        checksum of the merged range would be unknown. Otherwise the merged
+        ranges have no checksums.
+        """
+
+        if not self._f_bmap:
+            # Without bmap the ranges either do not need merging or are
+            # infinite
+            for block_range in self._get_block_ranges():
+                yield block_range
+            return
+
+        prev = None
+        for (first, last, chksum) in self._get_block_ranges():
+            if prev and prev[1] + 1 == first and \
+               (not keep_chksums or (prev[2] is None and chksum is None)):
+                prev = (prev[0], last, None)
+                continue
+
+            if prev:
+                yield prev
+            prev = (first, last, chksum)
+
+        if prev:
+            yield prev
+
     def _get_batches(self, first, last):
         """
         This is a helper generator which splits block ranges from the bmap file
@@ -516,62 +795,723 @@ class BmapCopy(object):
         if batch_blocks:
             yield (first, first + batch_blocks - 1, batch_blocks)
 
-    def _get_data(self, verify):
+    def _read_into(self, view, offset):
+        """
+        Read the image data at offset 'offset' into the 'view' memoryview and
+        return the number of bytes read, which is less than the length of
+        'view' only at the end of the image.
+
+        If the image is a local uncompressed file, the data are read from its
+        file descriptor with 'os.preadv()', which does not need a separate
+        seek. Otherwise the data are read from the image file object, which
+        has to be positioned at 'offset' already. Image file objects which have
+        no 'readinto()' method are read with 'read()'.
+        """
+
+        if self._image_preadv:
+            nbytes = 0
+            while nbytes < len(view):
+                chunk = os.preadv(self._image_fd, [view[nbytes:]],
+                                  offset + nbytes)
+                if not chunk:
+                    break
+                nbytes += chunk
+            return nbytes
+
+        readinto = getattr(self._f_image, "readinto", None)
+        if readinto is None:
+            buf = self._f_image.read(len(view))
+            view[:len(buf)] = buf
+            return len(buf)
+
+        nbytes = 0
+        while nbytes < len(view):
+            chunk = readinto(view[nbytes:])
+            if not chunk:
+                break
+            nbytes += chunk
+
+        return nbytes
+
+    def _put_batch(self, index, batch):
         """
-        This is generator  which reads the image file in '_batch_blocks' chunks
-        and yields ('type', 'start', 'end',  'buf) tuples, where:
+        Pass 'batch' stored in buffer number 'index' to the main thread and to
+        the hashing thread.
+        """
+
+        self._buf_info[index] = batch
+        self._buf_ready[index].set()
+        for lane_events in self._buf_hash_ready:
+            lane_events[index].set()
+
+    def _get_free_buf(self, index):
+        """
+        Wait until buffer number 'index' is not used by the main and the
+        hashing threads any more. Returns 'False' if copying was aborted.
+        """
+
+        self._buf_free[index].wait()
+        self._buf_free[index].clear()
+        return not self._copy_aborted
+
+    def _get_data(self):
+        """
+        This function runs in a separate thread and reads the image file in
+        '_batch_blocks' chunks into the '_bufs' buffers, which are used in a
+        round-robin fashion. For each buffer, it stores a ('range', 'start',
+        'end', 'nbytes', 'hash_info') tuple in '_buf_info', where:
           * 'start' is the starting block number of the batch;
           * 'end' is the last block of the batch;
-          * 'buf' a buffer containing the batch data.
+          * 'nbytes' is how many bytes of the buffer contain batch data (less
+            than the batch length only at the end of the image, which may end
+            in the middle of a block);
+          * 'hash_info' is 'None' if the batch does not have to be verified,
+            and a ('first', 'last', 'chksum', 'range_done') tuple describing
+            the block range the batch belongs to otherwise ('range_done' is
+            'True' for the last batch of the range).
+
+        In case of an error an ('error', 'exc_info') tuple is stored instead,
+        and 'None' is stored when there are no more data.
         """
 
         _log.debug("the reader thread has started")
+        index = 0
+        buf_is_ours = False
+        bufs_cnt = len(self._bufs)
+        # Save attribute look-ups in the loop
+        bufs = self._bufs
+        block_size = self.block_size
+        read_into = self._read_into
+        get_free_buf = self._get_free_buf
+        put_batch = self._put_batch
+
         try:
-            for (first, last, chksum) in self._get_block_ranges():
-                if verify and chksum:
-                    hash_obj = hashlib.new(self._cs_type)
+            ranges = self._get_coalesced_ranges(self._hashing)
+            for (first, last, chksum) in ranges:
+                if not self._hashing:
+                    chksum = None
 
-                self._f_image.seek(first * self.block_size)
+                if not self._image_preadv:
+                    self._f_image.seek(first * block_size)
 
                 iterator = self._get_batches(first, last)
                 for (start, end, length) in iterator:
+                    if not get_free_buf(index):
+                        return
+                    buf_is_ours = True
+
+                    view = memoryview(bufs[index])
                     try:
-                        buf = self._f_image.read(length * self.block_size)
+                        nbytes = read_into(view[:length * block_size],
+                                           start * block_size)
                     except IOError as err:
                         raise Error("error while reading blocks %d-%d of the "
                                     "image file '%s': %s"
                                     % (start, end, self._image_path, err))
 
-                    if not buf:
+                    if not nbytes:
                         _log.debug("no more data to read from file '%s'",
                                    self._image_path)
-                        self._batch_queue.put(None)
+                        put_batch(index, None)
                         return
 
-                    if verify and chksum:
-                        hash_obj.update(buf)
+                    if chksum:
+                        hash_info = (first, last, chksum, end == last)
+                    else:
+                        hash_info = None
 
-                    blocks = (len(buf) + self.block_size - 1) // self.block_size
-                    _log.debug("queueing %d blocks, queue length is %d" %
-                               (blocks, self._batch_queue.qsize()))
+                    if nbytes == length * block_size:
+                        blocks = length
+                    else:
+                        # This is the end of the image
+                        blocks = (nbytes + self._bs_mask) >> self._bs_shift
 
-                    self._batch_queue.put(("range", start, start + blocks - 1,
-                                           buf))
+                    _log.debug("passing %d blocks in buffer %d", blocks, index)
 
-                if verify and chksum and hash_obj.hexdigest() != chksum:
-                    raise Error("checksum mismatch for blocks range %d-%d: "
-                                "calculated %s, should be %s (image file %s)"
-                                % (first, last, hash_obj.hexdigest(),
-                                   chksum, self._image_path))
+                    put_batch(index, ("range", start, start + blocks - 1,
+                                      nbytes, hash_info))
+                    buf_is_ours = False
+                    index = (index + 1) % bufs_cnt
         # Silence pylint warning about catching too general exception
         # pylint: disable=W0703
         except Exception:
             # pylint: enable=W0703
-            # In case of any exception - just pass it to the main thread
-            # through the queue.
-            self._batch_queue.put(("error", sys.exc_info()))
+            # In case of any exception - just pass it to the main thread. The
+            # traceback refers to our frames, so drop their references to the
+            # buffers first.
+            view = None
+            exc_info = sys.exc_info()
+            if hasattr(traceback, "clear_frames"):
+                exc = exc_info[1]
+                while exc is not None:
+                    traceback.clear_frames(exc.__traceback__)
+                    exc = exc.__context__
+            if buf_is_ours or self._get_free_buf(index):
+                self._put_batch(index, ("error", exc_info))
+            return
+
+        if self._get_free_buf(index):
+            self._put_batch(index, None)
+
+    def _verify_range_chksum(self, first, last, hash_obj, chksum):
+        """
+        Compare the checksum of blocks range 'first'-'last' calculated by
+        'hash_obj' with 'chksum' from the bmap file and raise an exception if
+        they do not match.
+        """
+
+        calculated = hash_obj.hexdigest()
+        if calculated != chksum:
+            raise Error("checksum mismatch for blocks range %d-%d: "
+                        "calculated %s, should be %s (image file %s)"
+                        % (first, last, calculated, chksum, self._image_path))
+
+    def _hash_data(self, lane):
+        """
+        This function runs in a separate thread and verifies the checksums of
+        the batches the reader thread puts to the '_bufs' buffers. This way
+        reading the image overlaps with calculating the checksums and with
+        writing the data. Checksum mismatches are reported to the main thread
+        via '_hash_error'.
+
+        There may be several hashing threads ("lanes"), which calculate the
+        checksums of different block ranges in parallel. Every lane looks at
+        all the batches, but hashes only the block ranges number 'lane',
+        'lane' + '_hash_lanes', 'lane' + 2 * '_hash_lanes', etc.
+        """
+
+        _log.debug("hashing thread %d has started" % lane)
+        hash_obj = None
+        index = 0
+        range_index = 0
+        bufs_cnt = len(self._bufs)
+        buf_hash_ready = self._buf_hash_ready[lane]
+        buf_hashed = self._buf_hashed[lane]
+
+        while True:
+            buf_hash_ready[index].wait()
+            buf_hash_ready[index].clear()
+            if self._copy_aborted:
+                return
+
+            batch = self._buf_info[index]
+            if batch and batch[0] == "range" and batch[4]:
+                (first, last, chksum, range_done) = batch[4]
+
+                if range_index % self._hash_lanes == lane and \
+                   not self._hash_error:
+                    # The main thread waits for us, so do not let any
+                    # exception kill this thread, pass it to the main thread
+                    # instead
+                    try:
+                        if hash_obj is None:
+                            hash_obj = self._new_hash_obj()
+                        hash_obj.update(memoryview(self._bufs[index])
+                                        [:batch[3]])
+
+                        if range_done:
+                            self._verify_range_chksum(first, last, hash_obj,
+                                                      chksum)
+                    except Error as err:
+                        self._hash_error = (Error, err, None)
+                    # Silence pylint warning about catching too general
+                    # exception
+                    # pylint: disable=W0703
+                    except Exception:
+                        # pylint: enable=W0703
+                        self._hash_error = sys.exc_info()
+
+                    if range_done:
+                        hash_obj = None
+
+                if range_done:
+                    range_index += 1
+
+            buf_hashed[index].set()
+            if not batch or batch[0] == "error":
+                return
+            index = (index + 1) % bufs_cnt
+
+    def _copy_batches(self, verify):
+        """
+        Copy the image using the reader thread, which reads the image in
+        '_batch_blocks' chunks into a ring of pre-allocated buffers. While the
+        reader thread fills one buffer, we write the other ones to the
+        destination file. Returns a ('blocks_written', 'bytes_written') tuple.
+        """
+
+        # Use up to '_batch_queue_len' buffers, but do not let them take more
+        # than '_batch_queue_len' MiB, unless only 2 buffers are used.
+        bufs_cnt = (self._batch_queue_len * 1024 * 1024) // self._batch_bytes
+        bufs_cnt = max(2, min(bufs_cnt, self._batch_queue_len))
+        self._bufs = [_alloc_buf(self._batch_bytes) for _ in range(bufs_cnt)]
+        self._buf_info = [None] * bufs_cnt
+        self._buf_free = [threading.Event() for _ in range(bufs_cnt)]
+        self._buf_ready = [threading.Event() for _ in range(bufs_cnt)]
+        for event in self._buf_free:
+            event.set()
+
+        self._copy_aborted = False
+        self._hash_error = None
+        # Checksums are calculated in separate threads. 'hashlib' releases the
+        # GIL while hashing, so different block ranges can be hashed in
+        # parallel if there are several CPUs.
+        self._hashing = bool(verify and self._cs_type)
+        self._hash_lanes = 0
+        if self._hashing:
+            cpus_cnt = None
+            if hasattr(os, "cpu_count"):
+                cpus_cnt = os.cpu_count()
+            self._hash_lanes = max(1, min(cpus_cnt or 1, _MAX_HASH_LANES,
+                                          bufs_cnt - 1))
+
+        self._buf_hash_ready = [[threading.Event() for _ in range(bufs_cnt)]
+                                for _ in range(self._hash_lanes)]
+        self._buf_hashed = [[threading.Event() for _ in range(bufs_cnt)]
+                            for _ in range(self._hash_lanes)]
+
+        threads = [threading.Thread(target=self._get_data)]
+        for lane in range(self._hash_lanes):
+            threads.append(threading.Thread(target=self._hash_data,
+                                            args=(lane, )))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        blocks_written = 0
+        bytes_written = 0
+        index = 0
+        # Save attribute look-ups in the loop
+        block_size = self.block_size
+        buf_info = self._buf_info
+        buf_ready = self._buf_ready
+        write_batch = self._write_batch
+        sync_batch = self._sync_batch
+
+        try:
+            # Write the buffers filled by the reader thread to the destination
+            # file
+            while True:
+                buf_ready[index].wait()
+                buf_ready[index].clear()
+                batch = buf_info[index]
+
+                if batch and batch[0] == "range":
+                    (start, end, nbytes) = batch[1:4]
+                    length = (end - start + 1) * block_size
+
+                    assert nbytes <= length
+                    assert nbytes > length - block_size
+
+                    write_batch(start, end,
+                                memoryview(self._bufs[index])[:nbytes])
+
+                    blocks_written += (end - start + 1)
+                    bytes_written += nbytes
+                    sync_batch(start, end, blocks_written)
+
+                if self._hashing:
+                    for lane_events in self._buf_hashed:
+                        lane_events[index].wait()
+                        lane_events[index].clear()
+                    if self._hash_error:
+                        reraise(*self._hash_error)
+
+                self._buf_free[index].set()
+
+                if batch is None:
+                    # No more data, the image is written
+                    break
+                elif batch[0] == "error":
+                    # The reader thread encountered an error and passed us the
+                    # exception.
+                    exc_info = batch[1]
+                    self._buf_info[index] = None
+                    reraise(exc_info[0], exc_info[1], exc_info[2])
+
+                self._update_progress(blocks_written)
+                index = (index + 1) % bufs_cnt
+        except:
+            # Make the reader and the hashing threads exit
+            self._copy_aborted = True
+            for events in [self._buf_free] + self._buf_hash_ready:
+                for event in events:
+                    event.set()
+            raise
+
+        for thread in threads:
+            thread.join()
+
+        return (blocks_written, bytes_written)
+
+    def _get_uring_batches(self):
+        """
+        This is a helper generator for '_copy_uring()' which yields a ('start',
+        'end', 'nbytes', 'hash_info') tuple for every batch, where 'nbytes' is
+        how many bytes of the image the batch contains (less than the batch
+        size for the last block of the image). The other elements are the same
+        as in '_get_data()'.
+        """
+
+        for (first, last, chksum) in self._get_coalesced_ranges(self._hashing):
+            if not self._hashing:
+                chksum = None
+
+            for (start, end, length) in self._get_batches(first, last):
+                offset = start * self.block_size
+                nbytes = min(length * self.block_size,
+                             self.image_size - offset)
+                if nbytes <= 0:
+                    return
+
+                if chksum:
+                    hash_info = (first, last, chksum, end == last)
+                else:
+                    hash_info = None
+
+                blocks = (nbytes + self._bs_mask) >> self._bs_shift
+                yield (start, start + blocks - 1, nbytes, hash_info)
+
+    def _copy_uring(self, verify):
+        """
+        Copy the image using the Linux 'io_uring' interface, which is available
+        via the optional 'liburing' python module. Every batch is read from the
+        image by a 'read' request linked to a 'write' request to the
+        destination file, and up to '_URING_DEPTH' requests are in flight at
+        the same time, so the kernel does not have to wait for us between
+        reading and writing. This requires the image to be a local uncompressed
+        file of known size. Returns a ('blocks_written', 'bytes_written')
+        tuple, or 'None' if 'io_uring' cannot be used.
+        """
+
+        try:
+            import liburing
+        except ImportError:
+            return None
+
+        slots_cnt = (self._batch_queue_len * 1024 * 1024) // self._batch_bytes
+        slots_cnt = max(2, min(slots_cnt, _URING_DEPTH // 2))
+
+        ring = None
+        try:
+            ring = liburing.Ring()
+            cqe = liburing.Cqe()
+            liburing.io_uring_queue_init(slots_cnt * 2, ring)
+        except (AttributeError, TypeError, OSError) as err:
+            _log.debug("cannot use 'io_uring' for copying '%s' to '%s': %s"
+                       % (self._image_path, self._dest_path, err))
+            if ring is not None:
+                liburing.io_uring_queue_exit(ring)
+            return None
+
+        _log.debug("copying '%s' to '%s' using 'io_uring'"
+                   % (self._image_path, self._dest_path))
+
+        try:
+            return self._copy_uring_batches(liburing, ring, cqe, slots_cnt,
+                                            verify)
+        finally:
+            liburing.io_uring_queue_exit(ring)
+
+    def _copy_uring_batches(self, liburing, ring, cqe, slots_cnt, verify):
+        """
+        This is a helper for '_copy_uring()' which copies the batches using the
+        initialized 'ring' with 'slots_cnt' * 2 entries, and 'cqe' for
+        fetching completions.
+        """
+
+        self._hashing = bool(verify and self._cs_type)
+        # 'liburing' takes the I/O length from the length of the 'bytearray'
+        # buffer, so batches of other lengths get their own buffers
+        bufs = [bytearray(self._batch_bytes) for _ in range(slots_cnt)]
+        free_slots = list(range(slots_cnt))
+        # The submitted batches in the order of submission
+        pending = collections.deque()
+        # Results of the completed requests by their 'user_data' tags. The
+        # read request of slot 'X' is tagged '2 * X', the write request is
+        # tagged '2 * X + 1'.
+        results = {}
+        # The count of prepared but not yet submitted requests and the count of
+        # submitted but not yet completed requests
+        prepared = 0
+        inflight = 0
+
+        dest_fd = self._f_dest.fileno()
+        blocks_written = 0
+        bytes_written = 0
+        hash_obj = None
+        batches = self._get_uring_batches()
+
+        try:
+            while True:
+                # Keep all the free slots busy
+                while free_slots and batches is not None:
+                    batch = next(batches, None)
+                    if batch is None:
+                        batches = None
+                        break
+
+                    slot = free_slots.pop()
+                    offset = batch[0] * self.block_size
+                    nbytes = batch[2]
+                    if nbytes == self._batch_bytes:
+                        buf = bufs[slot]
+                    else:
+                        buf = bytearray(nbytes)
+
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_read(sqe, self._image_fd, buf,
+                                                offset)
+                    liburing.io_uring_sqe_set_flags(sqe,
+                                                    liburing.IOSQE_IO_LINK)
+                    sqe.user_data = 2 * slot
+
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_write(sqe, dest_fd, buf, offset)
+                    sqe.user_data = 2 * slot + 1
+                    prepared += 2
+
+                    pending.append((slot, buf) + batch)
+
+                if prepared:
+                    inflight += liburing.io_uring_submit(ring)
+                    prepared = 0
+
+                if not pending:
+                    break
+
+                # Batches are completed in the order of submission, so that
+                # the checksums can be calculated
+                (slot, buf, start, end, nbytes, hash_info) = pending.popleft()
+                while 2 * slot not in results or 2 * slot + 1 not in results:
+                    liburing.io_uring_wait_cqe(ring, cqe)
+                    try:
+                        res = cqe[0].res
+                    except OSError as err:
+                        # 'liburing' raises for negative results
+                        res = -err.errno
+                    results[cqe[0].user_data] = res
+                    liburing.io_uring_cqe_seen(ring, cqe[0])
+                    inflight -= 1
+
+                read_res = results.pop(2 * slot)
+                write_res = results.pop(2 * slot + 1)
+
+                if read_res < 0:
+                    raise Error("error while reading blocks %d-%d of the "
+                                "image file '%s': %s"
+                                % (start, end, self._image_path,
+                                   os.strerror(-read_res)))
+                if read_res < nbytes:
+                    raise Error("error while reading blocks %d-%d of the "
+                                "image file '%s': unexpected end of file"
+                                % (start, end, self._image_path))
+                if write_res < 0:
+                    raise Error("error while writing blocks %d-%d of '%s': %s"
+                                % (start, end, self._dest_path,
+                                   os.strerror(-write_res)))
+                if write_res < nbytes:
+                    # Finish the short write synchronously
+                    try:
+                        self._write_buf(start * self.block_size + write_res,
+                                        memoryview(buf)[write_res:])
+                    except OSError as err:
+                        raise Error("error while writing blocks %d-%d of "
+                                    "'%s': %s" % (start, end, self._dest_path,
+                                                  err))
+
+                if hash_info:
+                    (first, last, chksum, range_done) = hash_info
+                    if hash_obj is None:
+                        hash_obj = self._new_hash_obj()
+                    hash_obj.update(memoryview(buf)[:nbytes])
+                    if range_done:
+                        self._verify_range_chksum(first, last, hash_obj,
+                                                  chksum)
+                        hash_obj = None
+
+                free_slots.append(slot)
+                blocks_written += end - start + 1
+                bytes_written += nbytes
+                self._sync_batch(start, end, blocks_written)
+                self._update_progress(blocks_written)
+        finally:
+            # The kernel must not access the buffers after we return, so
+            # submit the prepared requests and wait for all of them
+            if prepared:
+                inflight += liburing.io_uring_submit(ring)
+            while inflight:
+                liburing.io_uring_wait_cqe(ring, cqe)
+                liburing.io_uring_cqe_seen(ring, cqe[0])
+                inflight -= 1
+
+        return (blocks_written, bytes_written)
+
+    def _write_buf(self, offset, buf):
+        """
+        Write buffer 'buf' to the destination file at offset 'offset'. The
+        data are written directly to the file descriptor, bypassing the
+        buffering of the destination file object. Errors are indicated by the
+        'OSError' exception.
+        """
+
+        dest_fd = self._f_dest.fileno()
+        view = memoryview(buf)
+
+        if not hasattr(os, "pwrite"):
+            # Python 2 does not have 'os.pwrite()'
+            os.lseek(dest_fd, offset, os.SEEK_SET)
+            while view:
+                view = view[os.write(dest_fd, view):]
+            return
+
+        while view:
+            written = os.pwrite(dest_fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _write_batch(self, start, end, buf):
+        """
+        Write buffer 'buf' containing blocks 'start' - 'end' of the image to the
+        destination file.
+        """
+
+        try:
+            self._write_buf(start * self.block_size, buf)
+        except OSError as err:
+            raise Error("error while writing blocks %d-%d of '%s': %s"
+                        % (start, end, self._dest_path, err))
+
+    def _copy_in_kernel(self):
+        """
+        Copy the image using the 'sendfile()' system call, so that the data
+        do not have to travel through user-space. This requires the image to
+        be a local uncompressed file. Returns a ('blocks_written',
+        'bytes_written') tuple, or 'None' if the kernel does not support
+        'sendfile()' for the image and the destination files.
+        """
+
+        dest_fd = self._f_dest.fileno()
+        blocks_written = 0
+        bytes_written = 0
+
+        for (first, last, _) in self._get_coalesced_ranges(False):
+            for (start, end, length) in self._get_batches(first, last):
+                offset = start * self.block_size
+                to_copy = length * self.block_size
+
+                try:
+                    os.lseek(dest_fd, offset, os.SEEK_SET)
+                    while to_copy:
+                        copied = os.sendfile(dest_fd, self._image_fd, offset,
+                                             to_copy)
+                        if not copied:
+                            break
+                        offset += copied
+                        to_copy -= copied
+                except OSError as err:
+                    if not bytes_written and \
+                       offset == start * self.block_size and \
+                       err.errno in (errno.EINVAL, errno.ENOSYS):
+                        _log.debug("cannot use 'sendfile()' for copying '%s' "
+                                   "to '%s': %s" % (self._image_path,
+                                                    self._dest_path, err))
+                        return None
+                    raise Error("error while copying blocks %d-%d of '%s' to "
+                                "'%s': %s" % (start, end, self._image_path,
+                                              self._dest_path, err))
+
+                copied = offset - start * self.block_size
+                if copied:
+                    blocks = (copied + self._bs_mask) >> self._bs_shift
+                    blocks_written += blocks
+                    bytes_written += copied
+                    self._sync_batch(start, start + blocks - 1, blocks_written)
+                    self._update_progress(blocks_written)
+
+                if to_copy:
+                    _log.debug("no more data to read from file '%s'",
+                               self._image_path)
+                    return (blocks_written, bytes_written)
+
+        return (blocks_written, bytes_written)
+
+    def _range_sync(self, offset, length, flags):
+        """
+        Invoke 'sync_file_range()' for 'length' bytes of the destination file
+        starting from 'offset'. Returns 'False' if the destination file does
+        not support it.
+        """
+
+        if _sync_file_range(self._f_dest.fileno(), offset, length, flags) == 0:
+            return True
+
+        err = ctypes.get_errno()
+        if err in (errno.EINVAL, errno.ESPIPE, errno.ENOSYS):
+            _log.debug("'sync_file_range()' is not supported for '%s': %s"
+                       % (self._dest_path, os.strerror(err)))
+            return False
 
-        self._batch_queue.put(None)
+        raise Error("cannot synchronize '%s': %s"
+                    % (self._dest_path, os.strerror(err)))
+
+    def _drop_cache(self, offset, length):
+        """
+        Advise the kernel that 'length' bytes of the destination file at
+        offset 'offset' are not going to be read, so that their pages are
+        dropped from the page cache once they are written back. This way
+        copying big images does not push everything else out of the page
+        cache.
+        """
+
+        if not self._dest_drop_cache:
+            return
+
+        try:
+            os.posix_fadvise(self._f_dest.fileno(), offset, length,
+                             os.POSIX_FADV_DONTNEED)
+        except OSError as err:
+            _log.debug("cannot drop page cache of '%s': %s"
+                       % (self._dest_path, err))
+            self._dest_drop_cache = False
+
+    def _sync_batch(self, start, end, blocks_written):
+        """
+        This function is called after blocks 'start' - 'end' were written to
+        the destination file, 'blocks_written' is the total count of written
+        blocks. If the destination file has to be synchronized while copying
+        ('_dest_fsync_watermark' is set), start write-back of the blocks and
+        wait for the write-back of the previous batch. This way the amount of
+        dirty data in the page cache stays small, but we do not stall waiting
+        for all of them in 'fsync()'. If 'sync_file_range()' is not supported,
+        synchronize the destination file every '_dest_fsync_watermark' blocks.
+        The previous batch is then dropped from the page cache.
+        """
+
+        batch_range = (start * self.block_size,
+                       (end - start + 1) * self.block_size)
+        prev_range = self._prev_batch_range
+        self._prev_batch_range = batch_range
+
+        if self._dest_fsync_watermark:
+            if self._range_sync_supported:
+                if self._range_sync(batch_range[0], batch_range[1],
+                                    _SYNC_FILE_RANGE_WRITE):
+                    if prev_range:
+                        self._range_sync(prev_range[0], prev_range[1],
+                                         _SYNC_FILE_RANGE_WAIT_BEFORE |
+                                         _SYNC_FILE_RANGE_WRITE |
+                                         _SYNC_FILE_RANGE_WAIT_AFTER)
+                else:
+                    self._range_sync_supported = False
+
+            if not self._range_sync_supported and \
+               blocks_written >= self._fsync_last + self._dest_fsync_watermark:
+                self._fsync_last = blocks_written
+                self.sync()
+
+        if prev_range:
+            self._drop_cache(prev_range[0], prev_range[1])
 
     def copy(self, sync=True, verify=True):
         """
@@ -581,65 +1521,43 @@ class BmapCopy(object):
         verified while copying.
         """
 
-        # Create the queue for block batches and start the reader thread, which
-        # will read the image in batches and put the results to '_batch_queue'.
-        self._batch_queue = Queue.Queue(self._batch_queue_len)
-        thread.start_new_thread(self._get_data, (verify, ))
-
-        blocks_written = 0
-        bytes_written = 0
-        fsync_last = 0
-
+        self._fsync_last = 0
+        self._prev_batch_range = None
         self._progress_started = False
         self._progress_index = 0
+        self._progress_percent = None
         self._progress_time = datetime.datetime.now()
 
         if self.image_size and self._dest_is_regfile:
             # If we already know image size, make sure that destination file
-            # has the same size as the image
+            # has the same size as the image. If the holes of the image are
+            # not copied, discard the old contents of the destination file
+            # first, so that the holes read as zeroes.
             try:
+                if self._image_data_ranges is not None:
+                    os.ftruncate(self._f_dest.fileno(), 0)
                 os.ftruncate(self._f_dest.fileno(), self.image_size)
             except OSError as err:
                 raise Error("cannot truncate file '%s': %s"
                             % (self._dest_path, err))
 
-        # Read the image in '_batch_blocks' chunks and write them to the
-        # destination file
-        while True:
-            batch = self._batch_queue.get()
-            if batch is None:
-                # No more data, the image is written
-                break
-            elif batch[0] == "error":
-                # The reader thread encountered an error and passed us the
-                # exception.
-                exc_info = batch[1]
-                reraise(exc_info[0], exc_info[1], exc_info[2])
+        # Local uncompressed images are copied using 'io_uring' if possible,
+        # or using 'sendfile()' if the data do not have to be verified, and
+        # using the reader thread otherwise.
+        counts = None
+        if self._image_fd is not None and self.image_size:
+            counts = self._copy_uring(verify)
 
-            (start, end, buf) = batch[1:4]
+        if counts is None and self._image_fd is not None and \
+           hasattr(os, "sendfile") and \
+           not (verify and self._cs_type):
+            # We do not need to look at the data, so let the kernel copy them
+            counts = self._copy_in_kernel()
 
-            assert len(buf) <= (end - start + 1) * self.block_size
-            assert len(buf) > (end - start) * self.block_size
+        if counts is None:
+            counts = self._copy_batches(verify)
 
-            self._f_dest.seek(start * self.block_size)
-
-            # Synchronize the destination file if we reached the watermark
-            if self._dest_fsync_watermark:
-                if blocks_written >= fsync_last + self._dest_fsync_watermark:
-                    fsync_last = blocks_written
-                    self.sync()
-
-            try:
-                self._f_dest.write(buf)
-            except IOError as err:
-                raise Error("error while writing blocks %d-%d of '%s': %s"
-                            % (start, end, self._dest_path, err))
-
-            self._batch_queue.task_done()
-            blocks_written += (end - start + 1)
-            bytes_written += len(buf)
-
-            self._update_progress(blocks_written)
+        (blocks_written, bytes_written) = counts
 
         if not self.image_size:
             # The image size was unknown up until now, set it
@@ -669,6 +1587,10 @@ class BmapCopy(object):
 
         if sync:
             self.sync()
+            # The last batch is written back now
+            if self._prev_batch_range:
+                self._drop_cache(self._prev_batch_range[0],
+                                 self._prev_batch_range[1])
 
     def sync(self):
         """
@@ -689,7 +1611,7 @@ class BmapBdevCopy(BmapCopy):
     This class is a specialized version of 'BmapCopy' which copies the image to
     a block device. Unlike the base 'BmapCopy' class, this class does various
     optimizations specific to block devices, e.g., switching to the 'noop' I/O
-    scheduler.
+    scheduler and writing with direct I/O.
     """
 
     def __init__(self, image, dest, bmap=None, image_size=None):
@@ -708,6 +1630,13 @@ class BmapBdevCopy(BmapCopy):
         self._sysfs_max_ratio_path = None
         self._old_scheduler_value = None
         self._old_max_ratio_value = None
+        # The ('name', 'old_value') tuples of the tuned queue attributes
+        self._old_queue_attrs = []
+
+        # Whether the block device is written with direct I/O
+        self._dio_enabled = False
+        # Direct I/O buffer lengths have to be aligned to this value
+        self._dio_align = None
 
         # If the image size is known, check that it fits the block device
         if self.image_size:
@@ -738,36 +1667,285 @@ class BmapBdevCopy(BmapCopy):
         self._sysfs_scheduler_path = self._sysfs_base + "queue/scheduler"
         self._sysfs_max_ratio_path = self._sysfs_base + "bdi/max_ratio"
 
+        # Direct I/O requires the buffers to be aligned at least to the
+        # logical block size of the block device. Aligning to the physical
+        # block size additionally avoids read-modify-write cycles in the
+        # device.
+        logical = self._read_queue_attr("logical_block_size", self.block_size)
+        physical = self._read_queue_attr("physical_block_size", logical)
+        self._dio_align = max(logical, physical)
+
+        # The default 1MiB batches are good for slow USB sticks, but fast
+        # devices benefit from larger batches. Make a batch contain several
+        # maximum-sized requests of the device, but keep it within 1-16MiB.
+        max_request = self._read_queue_attr("max_sectors_kb", 0) * 1024
+        optimal = self._read_queue_attr("optimal_io_size", 0)
+        batch_bytes = max(max_request * 4, optimal, 1024 * 1024)
+        batch_bytes = min(batch_bytes, 16 * 1024 * 1024)
+        batch_bytes -= batch_bytes % max(self._dio_align, self.block_size)
+        self._batch_bytes = batch_bytes
+        self._batch_blocks = self._batch_bytes // self.block_size
+
+    def _read_queue_attr(self, name, default):
+        """
+        Read an integer attribute 'name' of the block device queue from sysfs.
+        Returns 'default' if the attribute cannot be read.
+        """
+
+        path = self._sysfs_base + "queue/" + name
+        try:
+            with open(path, "r") as f_attr:
+                return int(f_attr.read().strip())
+        except (IOError, ValueError) as err:
+            _log.debug("cannot read '%s': %s" % (path, err))
+            return default
+
+    def _set_direct_io(self, enable):
+        """
+        Switch the block device file descriptor to direct I/O mode if 'enable'
+        is 'True', and back to buffered I/O mode otherwise.
+        """
+
+        dest_fd = self._f_dest.fileno()
+        flags = fcntl.fcntl(dest_fd, fcntl.F_GETFL)
+        if enable:
+            flags |= os.O_DIRECT
+        else:
+            flags &= ~os.O_DIRECT
+        fcntl.fcntl(dest_fd, fcntl.F_SETFL, flags)
+
+    def _enable_direct_io(self):
+        """
+        Switch the block device file descriptor to direct I/O mode, so that
+        the written data bypass the page cache. Direct I/O requires the data
+        buffers to be aligned, which is the case for the page-aligned batch
+        buffers, but not on Python 2 (see '_alloc_buf()').
+        """
+
+        if PY2:
+            _log.debug("batch buffers are not aligned on Python 2, not using "
+                       "direct I/O for '%s'" % self._dest_path)
+            return
+
+        if self._dio_align > mmap.PAGESIZE or \
+           self._batch_bytes % self._dio_align:
+            _log.debug("cannot align direct I/O buffers to %d bytes, not using "
+                       "direct I/O for '%s'" % (self._dio_align,
+                                                self._dest_path))
+            return
+
+        try:
+            self._set_direct_io(True)
+        except (IOError, OSError, AttributeError) as err:
+            _log.debug("cannot enable direct I/O for '%s': %s"
+                       % (self._dest_path, err))
+            return
+
+        self._dio_enabled = True
+
+    def _direct_io_works(self):
+        """
+        Returns 'True' if the block device can be written with direct I/O.
+        """
+
+        self._enable_direct_io()
+        works = self._dio_enabled
+        self._disable_direct_io()
+        return works
+
+    def _disable_direct_io(self):
+        """Switch the block device file descriptor back to buffered I/O mode."""
+
+        if not self._dio_enabled:
+            return
+
+        self._set_direct_io(False)
+        self._dio_enabled = False
+
+    def _write_batch(self, start, end, buf):
+        """
+        The same as in the base class, but writes with direct I/O if it is
+        enabled. Batches which do not start at a '_dio_align' boundary (e.g.,
+        when the bmap block size is smaller than the device block size) are
+        written with buffered I/O. So is the unaligned end of the last batch,
+        because the image may end in the middle of a device block, and the
+        data following the image must not be overwritten. If the block device
+        refuses direct I/O, fall back to buffered I/O for the rest of the
+        batches.
+        """
+
+        if not self._dio_enabled:
+            BmapCopy._write_batch(self, start, end, buf)
+            return
+
+        offset = start * self.block_size
+        aligned = len(buf) - len(buf) % self._dio_align
+        if offset % self._dio_align or not aligned:
+            self._write_buffered(start, end, offset, buf)
+            return
+
+        try:
+            self._write_buf(offset, memoryview(buf)[:aligned])
+            if aligned < len(buf):
+                self._write_buffered(start, end, offset + aligned,
+                                     memoryview(buf)[aligned:])
+            return
+        except OSError as err:
+            if err.errno != errno.EINVAL:
+                raise Error("error while writing blocks %d-%d of '%s': %s"
+                            % (start, end, self._dest_path, err))
+            _log.debug("direct I/O to '%s' failed, falling back to "
+                       "buffered I/O: %s" % (self._dest_path, err))
+
+        self._disable_direct_io()
+        BmapCopy._write_batch(self, start, end, buf)
+
+    def _write_buffered(self, start, end, offset, buf):
+        """
+        Write buffer 'buf' belonging to blocks 'start' - 'end' to offset
+        'offset' of the block device with buffered I/O while direct I/O is
+        enabled.
+        """
+
+        self._set_direct_io(False)
+        try:
+            self._write_buf(offset, buf)
+        except OSError as err:
+            raise Error("error while writing blocks %d-%d of '%s': %s"
+                        % (start, end, self._dest_path, err))
+        finally:
+            self._set_direct_io(True)
+
+    def _drop_cache(self, offset, length):
+        """
+        The same as in the base class, but does nothing when writing with
+        direct I/O, because the page cache is not used then.
+        """
+
+        if not self._dio_enabled:
+            BmapCopy._drop_cache(self, offset, length)
+
+    def _copy_uring(self, verify):
+        """
+        The same as in the base class, but only used if the block device
+        cannot be written with direct I/O. The 'io_uring' requests write from
+        'bytearray' buffers (see '_copy_uring_batches()'), which are not
+        aligned.
+        """
+
+        if self._direct_io_works():
+            return None
+        return BmapCopy._copy_uring(self, verify)
+
+    def _copy_in_kernel(self):
+        """
+        The same as in the base class, but only used if the block device
+        cannot be written with direct I/O, because 'sendfile()' writes via the
+        page cache.
+        """
+
+        if self._direct_io_works():
+            return None
+        return BmapCopy._copy_in_kernel(self)
+
+    def _copy_batches(self, verify):
+        """
+        The same as in the base class, but writes to the block device with
+        direct I/O, which avoids copying the data to the page cache and makes
+        the kernel dirty pages throttling irrelevant.
+        """
+
+        self._enable_direct_io()
+        try:
+            return BmapCopy._copy_batches(self, verify)
+        finally:
+            self._disable_direct_io()
+
+    def _set_queue_attr(self, name, value):
+        """
+        Write 'value' to attribute 'name' of the block device queue in sysfs.
+        Failures are not fatal, because this is only an optimization. Returns
+        'True' if the attribute has been set, and 'False' otherwise.
+        """
+
+        path = self._sysfs_base + "queue/" + name
+        try:
+            with open(path, "w") as f_attr:
+                f_attr.write(value)
+        except IOError as err:
+            _log.debug("cannot set '%s' to '%s': %s" % (path, value, err))
+            return False
+
+        return True
+
     def _tune_block_device(self):
         """
         Tune the block device for better performance:
-        1. Switch to the 'noop' I/O scheduler if it is available - sequential
-           write to the block device becomes a lot faster comparing to CFQ.
-        2. Limit the write buffering - we do not need the kernel to buffer a
+        1. Switch to the 'none' or the 'noop' I/O scheduler if it is available
+           (or to 'mq-deadline' if it is not) - sequential write to the block
+           device becomes a lot faster comparing to CFQ or BFQ.
+        2. Allow more requests in the queue, disable read-ahead, which is
+           useless because we only write, and stop the block device from
+           contributing to the entropy pool.
+        3. Limit the write buffering - we do not need the kernel to buffer a
            lot of the data we send to the block device, because we write
            sequentially. Limit the buffering.
 
         The old settings are saved in order to be able to restore them later.
         """
-        # Switch to the 'noop' I/O scheduler
+        # Save the queue attributes before switching the scheduler, because
+        # switching the scheduler resets some of them (e.g., 'nr_requests')
+        for name in _TUNED_QUEUE_ATTRS:
+            value = self._read_queue_attr(name, None)
+            if value is not None:
+                self._old_queue_attrs.append((name, value))
+
+        # Switch to the simplest I/O scheduler. The file contains a list of
+        # schedulers with the current scheduler in square brackets, e.g.,
+        # "noop deadline [cfq]".
         try:
-            with open(self._sysfs_scheduler_path, "r+") as f_scheduler:
+            with open(self._sysfs_scheduler_path, "r") as f_scheduler:
                 contents = f_scheduler.read()
-                f_scheduler.seek(0)
-                f_scheduler.write("noop")
         except IOError as err:
             _log.debug("failed to enable I/O optimization, expect "
-                         "suboptimal speed (reason: cannot switch to the "
-                         "'noop' I/O scheduler: %s or blk-mq in use)" % err)
-        else:
-            # The file contains a list of schedulers with the current
-            # scheduler in square brackets, e.g., "noop deadline [cfq]".
-            # Fetch the name of the current scheduler.
-            import re
-
-            match = re.match(r'.*\[(.+)\].*', contents)
-            if match:
-                self._old_scheduler_value = match.group(1)
+                       "suboptimal speed (reason: cannot read the I/O "
+                       "scheduler: %s)" % err)
+            contents = ""
+
+        opening = contents.find("[")
+        closing = contents.find("]", opening + 1)
+        if opening != -1 and closing != -1:
+            current = contents[opening + 1:closing]
+            available = contents.replace("[", " ").replace("]", " ").split()
+            for scheduler in ("none", "noop", "mq-deadline"):
+                if scheduler == current:
+                    break
+                if scheduler not in available:
+                    continue
+
+                try:
+                    with open(self._sysfs_scheduler_path, "w") as f_scheduler:
+                        f_scheduler.write(scheduler)
+                except IOError as err:
+                    _log.debug("cannot switch to the '%s' I/O scheduler: %s"
+                               % (scheduler, err))
+                else:
+                    self._old_scheduler_value = current
+                    break
+
+        # Changing the scheduler resets 'nr_requests', so tune the queue after
+        # switching the scheduler. The kernel refuses values larger than the
+        # hardware queue depth (e.g., with the 'none' scheduler of multi-queue
+        # devices), so try smaller values if 1024 does not work.
+        nr_requests = self._read_queue_attr("nr_requests", None)
+        if nr_requests is not None:
+            value = 1024
+            while value > nr_requests:
+                if self._set_queue_attr("nr_requests", str(value)):
+                    break
+                value //= 2
+        self._set_queue_attr("read_ahead_kb", "0")
+        self._set_queue_attr("add_random", "0")
 
         # Limit the write buffering, because we do not need too much of it when
         # writing sequntially. Excessive buffering makes some systems not very
@@ -796,6 +1974,20 @@ class BmapBdevCopy(BmapCopy):
                 raise Error("cannot restore the '%s' I/O scheduler: %s"
                             % (self._old_scheduler_value, err))
 
+        # Restore the queue attributes after the scheduler, which resets some
+        # of them
+        while self._old_queue_attrs:
+            (name, old_value) = self._old_queue_attrs.pop()
+            if self._read_queue_attr(name, None) == old_value:
+                continue
+            path = self._sysfs_base + "queue/" + name
+            try:
+                with open(path, "w") as f_attr:
+                    f_attr.write(str(old_value))
+            except IOError as err:
+                raise Error("cannot set '%s' back to '%s': %s"
+                            % (path, old_value, err))
+
         if self._old_max_ratio_value is not None:
             try:
                 with open(self._sysfs_max_ratio_path, "w") as f_ratio:
@@ -611,6 +611,25 @@ class TransRead(object):
 
         return buf
 
+    def readinto(self, buf):
+        """
+        Read the data into the pre-allocated writable 'buf' buffer, which saves
+        copying the data comparing to 'read()'. Returns the number of bytes
+        read, which may be less than the size of 'buf'.
+        """
+
+        readinto = getattr(self._f_objs[-1], "readinto", None)
+        if readinto is None:
+            data = self.read(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+
+        nbytes = readinto(buf)
+        if nbytes:
+            self._pos += nbytes
+
+        return nbytes
+
     def seek(self, offset, whence=os.SEEK_SET):
         """The 'seek()' method, similar to the one file objects have."""
         if self._fake_seek or not hasattr(self._f_objs[-1], "seek"):
@@ -31,12 +31,17 @@ file and the copy and verifies that they are identical.
 
 import os
 import sys
+import shutil
 import tempfile
 import filecmp
 import subprocess
+try:
+    from unittest.mock import patch
+except ImportError:     # for Python < 3.3
+    from mock import patch
 from six.moves import zip_longest
 from tests import helpers
-from bmaptools import BmapHelpers, BmapCreate, Filemap
+from bmaptools import BmapHelpers, BmapCreate, BmapCopy, Filemap, TransRead
 
 # This is a work-around for Centos 6
 try:
@@ -263,3 +268,405 @@ class TestCreateCopy(unittest.TestCase):
         for f_image, image_size, _, _ in iterator:
             assert image_size == os.path.getsize(f_image.name)
             _do_test(f_image.name, image_size, delete=delete)
+
+
+def _create_image(path, size, areas):
+    """
+    Create a sparse image file 'path' of 'size' bytes, which contains random
+    data in the areas described by the 'areas' list of ('offset', 'length')
+    tuples, and holes elsewhere.
+    """
+
+    with open(path, "wb") as f_image:
+        f_image.truncate(size)
+        for offset, length in areas:
+            f_image.seek(offset)
+            f_image.write(os.urandom(length))
+
+
+def _write_bmap(path, image_size, ranges, block_size=4096):
+    """
+    Write a bmap file 'path' of format version 1.2, which has no checksums,
+    for an image of 'image_size' bytes. The 'ranges' argument is a list of
+    block range strings, e.g. "0-3", which are not validated, so that broken
+    bmap files can be created too.
+    """
+
+    blocks_cnt = (image_size + block_size - 1) // block_size
+    with open(path, "w") as f_bmap:
+        f_bmap.write('<?xml version="1.0" ?>\n<bmap version="1.2">\n')
+        f_bmap.write("    <ImageSize> %d </ImageSize>\n" % image_size)
+        f_bmap.write("    <BlockSize> %d </BlockSize>\n" % block_size)
+        f_bmap.write("    <BlocksCount> %d </BlocksCount>\n" % blocks_cnt)
+        f_bmap.write("    <BlockMap>\n")
+        for blocks_range in ranges:
+            f_bmap.write("        <Range> %s </Range>\n" % blocks_range)
+        f_bmap.write("    </BlockMap>\n")
+        f_bmap.write("    <MappedBlocksCount> %d </MappedBlocksCount>\n"
+                     % blocks_cnt)
+        f_bmap.write("</bmap>\n")
+
+
+class TestCopyPaths(unittest.TestCase):
+    """
+    Test the different ways 'BmapCopy' copies images and its error handling.
+    """
+
+    def setUp(self):
+        """Create a temporary directory with a test image and its bmap."""
+
+        self._directory = tempfile.mkdtemp(prefix="testdir_", dir=".")
+        self._image = os.path.join(self._directory, "test.img")
+        self._bmap = self._image + ".bmap"
+        self._dest = os.path.join(self._directory, "test.img.copy")
+
+        # The image has a few mapped areas, and its size is not a multiple of
+        # the block size
+        self._image_size = 8 * 1024 * 1024 + 1234
+        _create_image(self._image, self._image_size,
+                      [(0, 300000), (3 * 1024 * 1024 + 100, 1024 * 1024),
+                       (8 * 1024 * 1024, 1234)])
+        BmapCreate.BmapCreate(self._image, self._bmap).generate()
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+
+        shutil.rmtree(self._directory)
+
+    def _copy(self, bmap, verify, copy_class=BmapCopy.BmapCopy):
+        """
+        Copy the test image to the destination file using the 'bmap' bmap file
+        (no bmap if it is 'None') and return the 'copy_class' object used for
+        copying.
+        """
+
+        f_image = TransRead.TransRead(self._image)
+        f_bmap = open(bmap, "r") if bmap else None
+        mode = "r+b" if os.path.exists(self._dest) else "w+b"
+        with open(self._dest, mode) as f_dest:
+            writer = copy_class(f_image, f_dest, f_bmap, self._image_size)
+            try:
+                writer.copy(False, verify)
+            finally:
+                if f_bmap:
+                    f_bmap.close()
+                f_image.close()
+
+        return writer
+
+    def test_io_uring(self):
+        """
+        Copy the image using 'io_uring', and make sure broken bmap files are
+        reported and do not make 'io_uring' wait for requests forever.
+        """
+
+        try:
+            import liburing  # pylint: disable=W0612
+        except ImportError:
+            self.skipTest("the 'liburing' module is not available")
+
+        with patch.object(BmapCopy.BmapCopy, "_copy_batches",
+                          side_effect=AssertionError("'io_uring' not used")):
+            for verify in (True, False):
+                self._copy(self._bmap, verify)
+                self.assertTrue(filecmp.cmp(self._image, self._dest, False))
+
+        _write_bmap(self._bmap, self._image_size, ["0-3", "768-900", "9-5"])
+        self.assertRaises(BmapCopy.Error, self._copy, self._bmap, False)
+
+    def test_bdev_direct_io(self):
+        """
+        Block devices which support direct I/O have to be written with direct
+        I/O, even if 'io_uring' or 'sendfile()' could be used.
+        """
+
+        with open(self._dest, "wb") as f_dest:
+            f_dest.truncate(self._image_size)
+            f_image = TransRead.TransRead(self._image)
+            writer = BmapCopy.BmapBdevCopy(f_image, f_dest, None,
+                                           self._image_size)
+            dio_works = writer._direct_io_works()
+            f_image.close()
+        if not dio_works:
+            self.skipTest("direct I/O is not supported")
+
+        error = AssertionError("direct I/O not used")
+        with patch.object(BmapCopy.BmapCopy, "_copy_uring",
+                          side_effect=error), \
+             patch.object(BmapCopy.BmapCopy, "_copy_in_kernel",
+                          side_effect=error):
+            for verify in (True, False):
+                self._copy(self._bmap, verify, BmapCopy.BmapBdevCopy)
+                self.assertTrue(filecmp.cmp(self._image, self._dest, False))
+
+    def test_checksum_mismatch(self):
+        """
+        Corrupt a mapped block of the image and make sure the checksum
+        mismatch is reported when the checksums are calculated by several
+        hashing threads, and that errors in hashing threads are passed to the
+        caller.
+        """
+
+        # Make sure the reader thread is used, and that several hashing
+        # threads are started even on a single-CPU machine
+        with patch.object(BmapCopy.BmapCopy, "_copy_uring",
+                          return_value=None), \
+             patch.object(BmapCopy.os, "cpu_count", create=True,
+                          return_value=4):
+            writer = self._copy(self._bmap, True)
+            self.assertGreater(writer._hash_lanes, 1)
+            self.assertTrue(filecmp.cmp(self._image, self._dest, False))
+
+            # Corrupt the last block range, which is not hashed by the first
+            # hashing thread
+            with open(self._image, "r+b") as f_image:
+                f_image.seek(8 * 1024 * 1024 + 100)
+                f_image.write(b"\0" if f_image.read(1) != b"\0" else b"\1")
+            self.assertRaises(BmapCopy.Error, self._copy, self._bmap, True)
+
+            # Copying without verification still works
+            self._copy(self._bmap, False)
+            self.assertTrue(filecmp.cmp(self._image, self._dest, False))
+
+            with patch.object(BmapCopy.BmapCopy, "_verify_range_chksum",
+                              side_effect=ValueError("hashing failed")):
+                self.assertRaises(ValueError, self._copy, self._bmap, True)
+
+    def test_no_bmap(self):
+        """
+        Copy the image without bmap to a new and to an existing regular file,
+        and make sure only the mapped areas of the image are copied, the holes
+        are preserved, and the old contents of the file are discarded.
+        """
+
+        # The default copying path, and the reader thread
+        for patches in ([], ["_copy_uring", "_copy_in_kernel"]):
+            for existing in (False, True):
+                if os.path.exists(self._dest):
+                    os.unlink(self._dest)
+                if existing:
+                    with open(self._dest, "wb") as f_dest:
+                        f_dest.write(b"Z" * (self._image_size + 4096))
+
+                patchers = [patch.object(BmapCopy.BmapCopy, name,
+                                         return_value=None)
+                            for name in patches]
+                for patcher in patchers:
+                    patcher.start()
+                try:
+                    writer = self._copy(None, False)
+                finally:
+                    for patcher in patchers:
+                        patcher.stop()
+
+                self.assertTrue(filecmp.cmp(self._image, self._dest, False))
+                if writer._image_data_ranges is None:
+                    raise unittest.SkipTest("the file-system does not support "
+                                            "SEEK_DATA and SEEK_HOLE")
+                self.assertLess(writer.mapped_cnt, writer.blocks_cnt)
+                try:
+                    _compare_holes(self._image, self._dest)
+                except Filemap.ErrorNotSupp:
+                    raise unittest.SkipTest("the file-system does not support "
+                                            "file mapping")
+
+    def test_coalesced_ranges(self):
+        """
+        Make sure adjacent block ranges are merged only when their checksums
+        are not needed or they have no checksums.
+        """
+
+        ranges = [(0, 3, "a"), (4, 7, "b"), (8, 9, None), (10, 11, None),
+                  (13, 14, None), (15, 16, "c"), (18, 18, None)]
+
+        with open(self._bmap, "r") as f_bmap, \
+             open(self._dest, "wb") as f_dest, \
+             open(self._image, "rb") as f_image:
+            writer = BmapCopy.BmapCopy(f_image, f_dest, f_bmap)
+            with patch.object(writer, "_get_block_ranges",
+                              side_effect=lambda: iter(ranges)):
+                self.assertEqual(list(writer._get_coalesced_ranges(True)),
+                                 [(0, 3, "a"), (4, 7, "b"), (8, 11, None),
+                                  (13, 14, None), (15, 16, "c"),
+                                  (18, 18, None)])
+                self.assertEqual(list(writer._get_coalesced_ranges(False)),
+                                 [(0, 11, None), (13, 16, None),
+                                  (18, 18, None)])
+
+    def test_broken_bmap(self):
+        """
+        Make sure a bmap file without the mapped blocks count and a malformed
+        bmap file are reported when the 'BmapCopy' object is created.
+        """
+
+        _write_bmap(self._bmap, self._image_size, ["0-3"])
+        with open(self._bmap, "r") as f_bmap:
+            contents = f_bmap.read()
+
+        for broken in ("\n".join(line for line in contents.split("\n")
+                                 if "MappedBlocksCount" not in line),
+                       contents[:len(contents) // 2]):
+            with open(self._bmap, "w") as f_bmap:
+                f_bmap.write(broken)
+
+            with open(self._bmap, "r") as f_bmap, \
+                 open(self._dest, "wb") as f_dest, \
+                 open(self._image, "rb") as f_image:
+                self.assertRaises(BmapCopy.Error, BmapCopy.BmapCopy, f_image,
+                                  f_dest, f_bmap)
+
+    def test_readinto(self):
+        """
+        Read compressed versions of the image using 'TransRead.readinto()' and
+        make sure the data and the file position are the same as with
+        'TransRead.read()'.
+        """
+
+        with open(self._image, "rb") as f_image:
+            data = f_image.read()
+
+        # The archivers need absolute paths
+        for compressed in _generate_compressed_files(
+                os.path.abspath(self._image)):
+            # An odd buffer size to make sure reads do not stay aligned
+            buf = bytearray(1024 * 1024 + 7)
+            chunks = []
+            f_image = TransRead.TransRead(compressed)
+            try:
+                while True:
+                    nbytes = f_image.readinto(buf)
+                    if not nbytes:
+                        break
+                    chunks.append(bytes(buf[:nbytes]))
+                    self.assertEqual(f_image.tell(), sum(len(chunk)
+                                                         for chunk in chunks))
+            finally:
+                f_image.close()
+
+            self.assertEqual(b"".join(chunks), data, compressed)
+
+            f_image = TransRead.TransRead(compressed)
+            try:
+                self.assertEqual(f_image.read(len(data) + 1), data, compressed)
+                self.assertEqual(f_image.tell(), len(data))
+            finally:
+                f_image.close()
+
+    def test_queue_tuning(self):
+        """
+        Make sure the block device queue size is increased as much as the
+        kernel allows, and that the I/O scheduler and the queue attributes are
+        restored afterwards, even though switching the scheduler resets
+        the queue size.
+        """
+
+        sysfs_base = os.path.join(self._directory, "sysfs") + os.sep
+        scheduler_path = os.path.join(sysfs_base, "queue", "scheduler")
+        attrs = {"queue/nr_requests": "64", "queue/read_ahead_kb": "128",
+                 "queue/add_random": "1", "bdi/max_ratio": "100"}
+
+        def read_attr(name):
+            """Read a sysfs attribute of the fake block device."""
+            with open(os.path.join(sysfs_base, name), "r") as f_attr:
+                return f_attr.read().strip()
+
+        def write_attr(name, value):
+            """Write a sysfs attribute of the fake block device."""
+            path = os.path.join(sysfs_base, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f_attr:
+                f_attr.write(value + "\n")
+
+        def fake_open(path, mode="r"):
+            """Reset the queue size when the scheduler is switched."""
+            if path == scheduler_path and "w" in mode:
+                write_attr("queue/nr_requests", "128")
+            return open(path, mode)
+
+        def set_queue_attr(writer, name, value):
+            """Refuse queue sizes larger than 256, like the kernel would."""
+            if name == "nr_requests" and int(value) > 256:
+                return False
+            return set_queue_attr.orig(writer, name, value)
+        set_queue_attr.orig = BmapCopy.BmapBdevCopy._set_queue_attr
+
+        for scheduler in (None, "[mq-deadline] none"):
+            for name, value in attrs.items():
+                write_attr(name, value)
+            if scheduler:
+                write_attr("queue/scheduler", scheduler)
+
+            with open(self._dest, "wb") as f_dest:
+                f_dest.truncate(self._image_size)
+                f_image = TransRead.TransRead(self._image)
+                writer = BmapCopy.BmapBdevCopy(f_image, f_dest, None,
+                                               self._image_size)
+                f_image.close()
+
+            writer._sysfs_base = sysfs_base
+            writer._sysfs_scheduler_path = scheduler_path
+            writer._sysfs_max_ratio_path = os.path.join(sysfs_base, "bdi",
+                                                        "max_ratio")
+            with patch.object(BmapCopy.BmapBdevCopy, "_set_queue_attr",
+                              autospec=True, side_effect=set_queue_attr), \
+                 patch.object(BmapCopy, "open", create=True,
+                              side_effect=fake_open):
+                writer._tune_block_device()
+                self.assertEqual(read_attr("queue/nr_requests"), "256")
+                self.assertEqual(read_attr("queue/read_ahead_kb"), "0")
+                self.assertEqual(read_attr("queue/add_random"), "0")
+                if scheduler:
+                    self.assertEqual(read_attr("queue/scheduler"), "none")
+
+                writer._restore_bdev_settings()
+
+            for name, value in attrs.items():
+                self.assertEqual(read_attr(name), value)
+            if scheduler:
+                self.assertEqual(read_attr("queue/scheduler"), "mq-deadline")
+
+    def test_unaligned_image_end(self):
+        """
+        Copy an image which ends in the middle of a block to a destination,
+        which is exactly as large as the image or larger, and make sure nothing
+        is written past the end of the image.
+        """
+
+        image_size = 12800
+        _create_image(self._image, image_size, [(0, image_size)])
+        BmapCreate.BmapCreate(self._image, self._bmap).generate()
+        with open(self._image, "rb") as f_image:
+            data = f_image.read()
+
+        for dest_size in (image_size, image_size + 8192):
+            for (bmap, verify) in ((self._bmap, True), (self._bmap, False),
+                                   (None, False)):
+                for copy_class in (BmapCopy.BmapCopy, BmapCopy.BmapBdevCopy):
+                    with open(self._dest, "wb") as f_dest:
+                        f_dest.write(b"Z" * dest_size)
+
+                    f_image = TransRead.TransRead(self._image)
+                    f_bmap = open(bmap, "r") if bmap else None
+                    try:
+                        with open(self._dest, "r+b") as f_dest:
+                            writer = copy_class(f_image, f_dest, f_bmap,
+                                                image_size)
+                            if copy_class is BmapCopy.BmapBdevCopy:
+                                # Pretend it is a block device, which is not
+                                # truncated to the image size
+                                writer._dest_is_regfile = False
+                            writer.copy(False, verify)
+                    finally:
+                        if f_bmap:
+                            f_bmap.close()
+                        f_image.close()
+
+                    with open(self._dest, "rb") as f_dest:
+                        copy = f_dest.read()
+                    if copy_class is BmapCopy.BmapCopy:
+                        # Regular files are truncated to the image size
+                        self.assertEqual(copy, data)
+                    else:
+                        self.assertEqual(copy, data + b"Z" * (dest_size -
+                                                              image_size))